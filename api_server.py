@@ -1,66 +1,132 @@
-from fastapi import FastAPI, Body
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from typing import List
 import uvicorn
 from dotenv import load_dotenv
 import os
-import requests
-import json
-import re
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import httpx
+from cachetools import LRUCache
+import orjson
+import msgspec
 from portia import Config, LogLevel, Portia, StorageClass
 from portia.open_source_tools.registry import example_tool_registry
+from contract_text import (
+    extract_fenced_block,
+    extract_json_object,
+    extract_solidity_surface,
+    normalize_solidity,
+)
+from inflight import coalesce
 
 load_dotenv()
 
-app = FastAPI()
-
-# Add CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:3000"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Worker processes started by `python api_server.py`; also used to split
+# per-process limits across workers
+UVICORN_WORKERS = int(os.getenv("UVICORN_WORKERS", max(2, (os.cpu_count() or 1) * 2 + 1)))
 
 # Venice API configuration
 VENICE_API_KEY = os.getenv("VENICE_API_KEY")
 VENICE_API_URL = "https://api.venice.ai/api/v1"
 
-# Define request models with Pydantic
-class ContractRequest(BaseModel):
+# A non-streamed completion sends nothing until generation finishes, so the read
+# timeout bounds total generation time; the default leaves room for 3000 tokens
+VENICE_READ_TIMEOUT = float(os.getenv("VENICE_READ_TIMEOUT", "120"))
+
+# Shared async client so Venice calls don't block the event loop. Keeping
+# connections alive (and multiplexed over HTTP/2) avoids a TLS handshake per call.
+def create_venice_client():
+    return httpx.AsyncClient(
+        base_url=VENICE_API_URL,
+        headers={"Authorization": f"Bearer {VENICE_API_KEY}"},
+        # Fail fast on a stalled Venice call instead of pinning the request
+        timeout=httpx.Timeout(connect=5.0, read=VENICE_READ_TIMEOUT, write=10.0, pool=5.0),
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=100,
+            max_keepalive_connections=50,
+            keepalive_expiry=30.0,
+        ),
+    )
+
+# Created per worker in lifespan
+venice_client = None
+
+# Code fences that may wrap JSON in Venice responses, tried in order
+_JSON_FENCES = ("```json\n", "```\n")
+
+# Request models are msgspec Structs decoded straight from the raw body, which
+# is much cheaper per request than Pydantic validation
+class ContractRequest(msgspec.Struct):
     contract_code: str
 
-class TranslateRequest(BaseModel):
+class BatchContractRequest(msgspec.Struct):
+    contracts: List[ContractRequest]
+
+class TranslateRequest(msgspec.Struct):
     source_code: str
     target_language: str
 
-class InsuranceRequest(BaseModel):
+class InsuranceRequest(msgspec.Struct):
     contract_code: str
     tvl: float
 
-class RecommendationRequest(BaseModel):
+class RecommendationRequest(msgspec.Struct):
     contract_code: str
     analysis: dict
 
+contract_decoder = msgspec.json.Decoder(ContractRequest)
+batch_decoder = msgspec.json.Decoder(BatchContractRequest)
+translate_decoder = msgspec.json.Decoder(TranslateRequest)
+insurance_decoder = msgspec.json.Decoder(InsuranceRequest)
+recommendation_decoder = msgspec.json.Decoder(RecommendationRequest)
+
+json_encoder = msgspec.json.Encoder()
+
+async def decode_body(request: Request, decoder):
+    return decoder.decode(await request.body())
+
+# Encode with msgspec and bypass FastAPI's response encoding entirely
+def msgspec_response(content, status_code=200):
+    return Response(content=json_encoder.encode(content), status_code=status_code,
+                    media_type="application/json")
+
+# Plans and runs are kept in memory: the API is stateless and DISK storage
+# writes synchronously on every plan/run. Set PORTIA_STORAGE_CLASS=DISK to
+# persist them under blockchain_runs (run_plan already runs off the event loop).
+# If the in-memory store turns out to grow without bound in long-running
+# workers, set PORTIA_STORAGE_RESET_SECONDS to replace the Portia instance (and
+# with it the store) periodically.
+PORTIA_STORAGE_CLASS = StorageClass[os.getenv("PORTIA_STORAGE_CLASS", "MEMORY")]
+
 # Configure Portia
 my_config = Config.from_default(
-    storage_class=StorageClass.DISK, 
-    storage_dir='blockchain_runs',
-    default_log_level=LogLevel.DEBUG,
+    storage_class=PORTIA_STORAGE_CLASS,
+    **({"storage_dir": "blockchain_runs"} if PORTIA_STORAGE_CLASS == StorageClass.DISK else {}),
+    default_log_level=LogLevel[os.getenv("PORTIA_LOG_LEVEL", "INFO")],
 )
 
-# Instantiate Portia
-portia = Portia(config=my_config, tools=example_tool_registry)
+def create_portia():
+    return Portia(config=my_config, tools=example_tool_registry)
 
-# Function to call Venice API
-def call_venice_api(messages, temperature=0.1, max_tokens=2000):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {VENICE_API_KEY}"
-    }
-    
-    payload = {
+# Created per worker in lifespan
+portia = None
+
+# Portia's plan/run_plan are blocking, so they run in their own bounded
+# threadpool; the pool size is the cap on concurrent Portia calls. The loop's
+# default executor is left alone for DNS lookups and other to_thread users.
+PORTIA_MAX_WORKERS = int(os.getenv("PORTIA_MAX_WORKERS", "8"))
+portia_executor = None
+
+async def run_portia(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(portia_executor, func, *args)
+
+def venice_payload(messages, temperature, max_tokens):
+    return {
         "model": "default",
         "messages": messages,
         "temperature": temperature,
@@ -69,16 +135,267 @@ def call_venice_api(messages, temperature=0.1, max_tokens=2000):
             "include_venice_system_prompt": False
         }
     }
-    
+
+# Output budget scaled to the input: small contracts don't need 3000 tokens.
+# The floor leaves room for the full structured JSON on tiny inputs.
+VENICE_MIN_TOKENS = int(os.getenv("VENICE_MIN_TOKENS", "1024"))
+
+def venice_max_tokens(code, cap=3000):
+    return min(cap, VENICE_MIN_TOKENS + len(code) // 4)
+
+# Cap on concurrent Venice calls, so a burst of requests doesn't turn into a
+# burst of upstream calls (429s, connection churn). VENICE_MAX_CONCURRENCY is the
+# total across all workers; the semaphore is per process, so each worker gets
+# an equal share. When launching uvicorn directly, set UVICORN_WORKERS to the
+# worker count so the share is computed correctly.
+VENICE_MAX_CONCURRENCY = int(os.getenv("VENICE_MAX_CONCURRENCY", "32"))
+venice_semaphore = asyncio.Semaphore(max(1, VENICE_MAX_CONCURRENCY // UVICORN_WORKERS))
+
+# Venice calls in flight keyed by payload hash; identical concurrent calls
+# share one upstream call
+venice_inflight = {}
+
+def venice_payload_key(payload):
+    return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+async def post_venice(payload):
     try:
-        response = requests.post(f"{VENICE_API_URL}/chat/completions", 
-                                headers=headers, 
-                                json=payload)
-        return response.json()
+        async with venice_semaphore:
+            response = await venice_client.post("/chat/completions", json=payload)
+        return orjson.loads(response.content)
+    except httpx.TimeoutException:
+        # Surfaced as a 504 rather than falling back to a slow Portia run
+        raise
     except Exception as e:
         print(f"Error calling Venice API: {e}")
         return None
 
+# Function to call Venice API
+async def call_venice_api(messages, temperature=0.1, max_tokens=2000):
+    payload = venice_payload(messages, temperature, max_tokens)
+    return await coalesce(venice_inflight, venice_payload_key(payload), lambda: post_venice(payload))
+
+# Streaming variant of call_venice_api: yields content deltas from Venice's SSE
+# stream. Raises if the stream ends before [DONE], since the content is partial.
+async def stream_venice_api(messages, temperature=0.1, max_tokens=2000):
+    payload = {**venice_payload(messages, temperature, max_tokens), "stream": True}
+    
+    # Streams aren't coalesced, but they count against the same upstream limit
+    async with venice_semaphore, venice_client.stream("POST", "/chat/completions", json=payload) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                return
+            choices = orjson.loads(data).get("choices") or []
+            if choices:
+                delta = choices[0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+    raise RuntimeError("Venice stream ended before [DONE]")
+
+def sse_event(data):
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+# Cache of final responses keyed by request content, plus the computations in
+# flight, so concurrent duplicates wait on the same result. Both are per worker
+# process.
+analysis_cache = LRUCache(maxsize=int(os.getenv("ANALYSIS_CACHE_SIZE", "512")))
+analysis_inflight = {}
+cache_stats = {"hits": 0, "coalesced": 0, "misses": 0}
+
+def cache_key(endpoint, *parts):
+    return hashlib.sha256("|".join([endpoint, *map(str, parts)]).encode()).hexdigest()
+
+# Contracts shorter than this are always sent to Venice in full
+SURFACE_MIN_CHARS = int(os.getenv("SURFACE_MIN_CHARS", "4000"))
+surface_cache = LRUCache(maxsize=int(os.getenv("ANALYSIS_CACHE_SIZE", "512")))
+
+# Tells the model the code it sees is an outline, so it doesn't judge the
+# elided bodies as if they were the real code
+OUTLINE_NOTE = (
+    "Note: this contract is large, so it is given as an outline. Comments are removed "
+    "and each function body is cut to its first line, with the rest replaced by "
+    "\"// ...\". Don't treat elided code as missing; the full source is analyzed when "
+    "the request is made with deep=true.\n\n"
+)
+
+def contract_for_prompt(code, deep=False):
+    if deep or len(code) < SURFACE_MIN_CHARS:
+        return code
+    key = cache_key("surface", normalize_solidity(code))
+    surface = surface_cache.get(key)
+    if surface is None:
+        surface = extract_solidity_surface(code)
+        # The extractor returns the code unchanged when it can't outline it
+        if surface is not code:
+            surface = OUTLINE_NOTE + surface
+        surface_cache[key] = surface
+    return surface
+
+async def cached_response(key, compute):
+    entry = analysis_cache.get(key)
+    if entry is not None:
+        cache_stats["hits"] += 1
+        return entry
+
+    cache_stats["coalesced" if key in analysis_inflight else "misses"] += 1
+    result = await coalesce(analysis_inflight, key, compute)
+
+    # Errors and the degraded Portia fallback are handed to anyone already
+    # waiting, but never cached, so the next request retries Venice
+    if "error" not in result and result.get("venice_used"):
+        analysis_cache[key] = result
+    return result
+
+# Plans keyed by prompt hash, so repeated prompts skip re-planning. Entries
+# remember the Portia instance that made them, since a plan is only run on the
+# instance whose storage holds it.
+plan_cache = LRUCache(maxsize=int(os.getenv("ANALYSIS_CACHE_SIZE", "512")))
+
+async def get_plan(instance, prompt):
+    key = cache_key("plan", prompt)
+    entry = plan_cache.get(key)
+    if entry is not None and entry[0] is instance:
+        return entry[1]
+    plan = await run_portia(instance.plan, prompt)
+    # Don't cache a plan whose instance was replaced while it was being made
+    if instance is portia:
+        plan_cache[key] = (instance, plan)
+    return plan
+
+# Portia's plan is only reported back, not fed into Venice, so run both at once.
+# Without include_plan the plan is only generated if Venice fails and the
+# Portia fallback needs it.
+async def plan_and_call_venice(instance, prompt, messages, temperature=0.1, max_tokens=2000, include_plan=True):
+    if not include_plan:
+        venice_response = await call_venice_api(messages, temperature=temperature, max_tokens=max_tokens)
+        if venice_response_ok(venice_response):
+            return None, venice_response
+        return await get_plan(instance, prompt), venice_response
+    
+    plan, venice_response = await asyncio.gather(
+        get_plan(instance, prompt),
+        call_venice_api(messages, temperature=temperature, max_tokens=max_tokens),
+        return_exceptions=True,
+    )
+    if isinstance(venice_response, httpx.TimeoutException):
+        raise venice_response
+    if isinstance(venice_response, Exception):
+        print(f"Error calling Venice API: {venice_response}")
+        venice_response = None
+    if isinstance(plan, Exception):
+        # Without a Venice answer there is nothing to fall back on
+        if not venice_response_ok(venice_response):
+            raise plan
+        print(f"Error generating Portia plan: {plan}")
+        plan = None
+    return plan, venice_response
+
+def parse_venice_json(content):
+    try:
+        for fence in _JSON_FENCES:
+            json_str = extract_fenced_block(content, fence)
+            if json_str is not None:
+                return orjson.loads(json_str)
+        json_str = extract_json_object(content)
+        if json_str is None:
+            return {"raw_response": content}
+        return orjson.loads(json_str)
+    except Exception as e:
+        print(f"Error parsing JSON content: {e}")
+        return {"raw_response": content}
+
+# mode="json" lets pydantic-core produce plain JSON types in one pass, so the
+# response encoder doesn't have to walk the tree again
+def dump_model(model):
+    return model.model_dump(mode="json", exclude_none=True)
+
+def venice_result(plan, value, content):
+    return {
+        "plan": dump_model(plan) if plan else None,
+        "results": {
+            "outputs": {
+                "final_output": {
+                    "value": value,
+                    "summary": content[:500] + "..." if len(content) > 500 else content
+                }
+            }
+        },
+        "venice_used": True
+    }
+
+# By default only the final output and the plan (if any) are returned;
+# verbose=true keeps the full Portia run for debugging
+def shape_response(response, verbose):
+    if verbose or "error" in response:
+        return response
+    outputs = (response.get("results") or {}).get("outputs") or {}
+    final_output = outputs.get("final_output") or {}
+    return {
+        "structured_analysis": final_output.get("value"),
+        "summary": final_output.get("summary"),
+        # Set when include_plan=true (or the Portia fallback needed one), else null
+        "plan": response.get("plan"),
+        "venice_used": response["venice_used"]
+    }
+
+def venice_response_ok(venice_response):
+    return bool(venice_response and "choices" in venice_response and len(venice_response["choices"]) > 0)
+
+# Off by default (0). Each request captures the instance once and uses it for
+# both plan and run_plan, so a swap never splits a request across instances.
+PORTIA_STORAGE_RESET_SECONDS = int(os.getenv("PORTIA_STORAGE_RESET_SECONDS", "0"))
+
+async def reset_portia_storage():
+    global portia
+    while True:
+        await asyncio.sleep(PORTIA_STORAGE_RESET_SECONDS)
+        portia = create_portia()
+        plan_cache.clear()
+
+# Clients, Portia and its threadpool are built here rather than at import, so
+# only worker processes create them, not the uvicorn supervisor
+@asynccontextmanager
+async def lifespan(app):
+    global venice_client, portia, portia_executor
+    venice_client = create_venice_client()
+    portia = create_portia()
+    portia_executor = ThreadPoolExecutor(max_workers=PORTIA_MAX_WORKERS)
+    reset_task = None
+    if PORTIA_STORAGE_CLASS == StorageClass.MEMORY and PORTIA_STORAGE_RESET_SECONDS > 0:
+        reset_task = asyncio.create_task(reset_portia_storage())
+    try:
+        yield
+    finally:
+        if reset_task is not None:
+            reset_task.cancel()
+        await venice_client.aclose()
+        portia_executor.shutdown(wait=False)
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# Add CORS middleware
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["http://localhost:3000"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+@app.exception_handler(httpx.TimeoutException)
+async def venice_timeout_handler(request, exc):
+    print(f"Venice API timed out: {exc}")
+    return msgspec_response({"error": "Venice API timed out"}, status_code=504)
+
+@app.exception_handler(msgspec.DecodeError)
+async def invalid_body_handler(request, exc):
+    # ValidationError subclasses DecodeError, so malformed and mistyped bodies both land here
+    return msgspec_response({"detail": str(exc)}, status_code=422)
+
 @app.get("/")
 async def root():
     return {"message": "Portia API with Venice integration is running"}
@@ -87,113 +404,215 @@ async def root():
 async def health_check():
     return {"status": "ok"}
 
+@app.get("/cache-stats")
+async def get_cache_stats():
+    lookups = sum(cache_stats.values())
+    return {
+        **cache_stats,
+        "size": len(analysis_cache),
+        "maxsize": analysis_cache.maxsize,
+        "hit_rate": (cache_stats["hits"] + cache_stats["coalesced"]) / lookups if lookups else 0.0
+    }
+
+def build_analysis_prompt(contract_code):
+    return f"""Analyze this smart contract for security vulnerabilities:
+            {contract_code}
+            
+            Provide a comprehensive security analysis with scores and details.
+            """
+
+def build_analysis_messages(contract_code, deep=False):
+    return [
+        {
+            "role": "system",
+            "content": """You are a smart contract security analyzer. Analyze the following contract for vulnerabilities and security issues. 
+            Respond with a JSON object that has the following structure:
+            {
+              "overall_score": number from 0-100,
+              "complexity": {
+                "score": number from 0-100,
+                "details": array of strings with findings,
+                "risk_level": "Low", "Medium", or "High"
+              },
+              "vulnerabilities": {
+                "score": number from 0-100,
+                "details": array of strings describing vulnerabilities,
+                "risk_level": "Low", "Medium", or "High"
+              },
+              "upgradability": {
+                "score": number from 0-100,
+                "details": array of strings with findings,
+                "risk_level": "Low", "Medium", or "High"
+              },
+              "behavior": {
+                "score": number from 0-100,
+                "details": array of strings with findings,
+                "risk_level": "Low", "Medium", or "High"
+              }
+            }"""
+        },
+        {
+            "role": "user",
+            "content": f"Analyze this smart contract:\n\n{contract_for_prompt(contract_code, deep)}"
+        }
+    ]
+
 @app.post("/analyze-contract")
-async def analyze_contract(request: ContractRequest):
+async def analyze_contract(http_request: Request, verbose: bool = False, deep: bool = False,
+                           include_plan: bool = False):
+    request = await decode_body(http_request, contract_decoder)
+    return msgspec_response(shape_response(await cached_analysis(request, deep, include_plan), verbose))
+
+async def cached_analysis(request: ContractRequest, deep=False, include_plan=False):
+    key = cache_key("analyze-contract", normalize_solidity(request.contract_code), deep, include_plan)
+    return await cached_response(key, lambda: _analyze_contract(request, deep, include_plan))
+
+async def _analyze_contract(request: ContractRequest, deep=False, include_plan=False):
     print(f"Received contract code: {request.contract_code[:100]}...")
+    # Plan and fallback run must use the same Portia instance
+    instance = portia
     
     try:
-        # Try using Portia first for the plan generation
-        analysis_plan = portia.plan(
-            f"""Analyze this smart contract for security vulnerabilities:
-            {request.contract_code}
-            
-            Provide a comprehensive security analysis with scores and details.
-            """
-        )
+        # Prompt for the Portia plan, generated alongside the Venice call
+        analysis_prompt = build_analysis_prompt(request.contract_code)
         
         # Now use Venice for the actual analysis
-        venice_messages = [
-            {
-                "role": "system",
-                "content": """You are a smart contract security analyzer. Analyze the following contract for vulnerabilities and security issues. 
-                Respond with a JSON object that has the following structure:
-                {
-                  "overall_score": number from 0-100,
-                  "complexity": {
-                    "score": number from 0-100,
-                    "details": array of strings with findings,
-                    "risk_level": "Low", "Medium", or "High"
-                  },
-                  "vulnerabilities": {
-                    "score": number from 0-100,
-                    "details": array of strings describing vulnerabilities,
-                    "risk_level": "Low", "Medium", or "High"
-                  },
-                  "upgradability": {
-                    "score": number from 0-100,
-                    "details": array of strings with findings,
-                    "risk_level": "Low", "Medium", or "High"
-                  },
-                  "behavior": {
-                    "score": number from 0-100,
-                    "details": array of strings with findings,
-                    "risk_level": "Low", "Medium", or "High"
-                  }
-                }"""
-            },
-            {
-                "role": "user",
-                "content": f"Analyze this smart contract:\n\n{request.contract_code}"
-            }
-        ]
+        venice_messages = build_analysis_messages(request.contract_code, deep)
         
-        venice_response = call_venice_api(venice_messages, temperature=0.1, max_tokens=3000)
+        analysis_plan, venice_response = await plan_and_call_venice(
+            instance, analysis_prompt, venice_messages, temperature=0.1,
+            max_tokens=venice_max_tokens(request.contract_code), include_plan=include_plan
+        )
         
         # Check if Venice response is valid
-        if venice_response and "choices" in venice_response and len(venice_response["choices"]) > 0:
+        if venice_response_ok(venice_response):
             content = venice_response["choices"][0]["message"]["content"]
             
             # Extract JSON from content if needed
-            try:
-                json_match = re.search(r'```json\n([\s\S]*?)\n```', content) or re.search(r'```\n([\s\S]*?)\n```', content) or re.search(r'{[\s\S]*?}', content)
-                if json_match:
-                    json_str = json_match.group(0).replace('```json\n', '').replace('```\n', '').replace('```', '')
-                    parsed_content = json.loads(json_str)
-                else:
-                    parsed_content = {"raw_response": content}
-            except Exception as e:
-                print(f"Error parsing JSON content: {e}")
-                parsed_content = {"raw_response": content}
+            parsed_content = parse_venice_json(content)
             
-            # Return both Portia plan and Venice analysis
-            return {
-                "plan": analysis_plan.model_dump(),
-                "results": {
-                    "outputs": {
-                        "final_output": {
-                            "value": parsed_content,
-                            "summary": content[:500] + "..." if len(content) > 500 else content
-                        }
-                    }
-                },
-                "venice_used": True
-            }
+            return venice_result(analysis_plan, parsed_content, content)
         else:
             # Fallback to Portia if Venice fails
-            plan_run = portia.run_plan(analysis_plan)
+            plan_run = await run_portia(instance.run_plan, analysis_plan)
             return {
-                "plan": analysis_plan.model_dump(),
-                "results": plan_run.model_dump(),
+                "plan": dump_model(analysis_plan),
+                "results": dump_model(plan_run),
                 "venice_used": False
             }
+    except httpx.TimeoutException:
+        raise
     except Exception as e:
         print(f"Error in analyze_contract: {str(e)}")
         return {"error": str(e)}
 
+@app.post("/analyze-contract/stream")
+async def analyze_contract_stream(http_request: Request, verbose: bool = False, deep: bool = False,
+                                  include_plan: bool = False):
+    request = await decode_body(http_request, contract_decoder)
+    print(f"Streaming analysis for contract code: {request.contract_code[:100]}...")
+    key = cache_key("analyze-contract", normalize_solidity(request.contract_code), deep, include_plan)
+    
+    async def events():
+        cached = analysis_cache.get(key)
+        if cached is not None:
+            cache_stats["hits"] += 1
+            yield sse_event({"done": True, "response": shape_response(cached, verbose)})
+            return
+        
+        cache_stats["misses"] += 1
+        # The plan is built in the background while Venice tokens are relayed
+        plan_task = None
+        if include_plan:
+            plan_task = asyncio.create_task(get_plan(portia, build_analysis_prompt(request.contract_code)))
+        chunks = []
+        try:
+            try:
+                async for delta in stream_venice_api(
+                    build_analysis_messages(request.contract_code, deep), temperature=0.1,
+                    max_tokens=venice_max_tokens(request.contract_code)
+                ):
+                    chunks.append(delta)
+                    yield sse_event({"delta": delta})
+            except Exception as e:
+                print(f"Error streaming from Venice API: {e}")
+                yield sse_event({"error": str(e)})
+                return
+            
+            content = "".join(chunks)
+            analysis_plan = None
+            if plan_task is not None:
+                try:
+                    analysis_plan = await plan_task
+                except Exception as e:
+                    print(f"Error generating Portia plan: {e}")
+            
+            # Store the same payload /analyze-contract would have returned, unless
+            # Venice sent no content (e.g. an error object instead of choices) or
+            # a non-stream request is already computing this entry
+            result = venice_result(analysis_plan, parse_venice_json(content), content)
+            if content and key not in analysis_inflight:
+                analysis_cache[key] = result
+            yield sse_event({"done": True, "response": shape_response(result, verbose)})
+        finally:
+            # Don't leave the plan running after an error or a client disconnect
+            if plan_task is not None and not plan_task.done():
+                plan_task.cancel()
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+# How many contracts from one batch are analyzed at the same time
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
+
+# Larger batches are rejected so one request can't queue unbounded work
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "50"))
+
+@app.post("/analyze-contract/batch")
+async def analyze_contract_batch(http_request: Request, verbose: bool = False, deep: bool = False,
+                                 include_plan: bool = False):
+    request = await decode_body(http_request, batch_decoder)
+    if len(request.contracts) > BATCH_MAX_SIZE:
+        return msgspec_response(
+            {"detail": f"Batch has {len(request.contracts)} contracts; the maximum is {BATCH_MAX_SIZE}"},
+            status_code=422,
+        )
+    print(f"Received batch of {len(request.contracts)} contracts")
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+    
+    async def analyze_one(contract):
+        async with semaphore:
+            return shape_response(await cached_analysis(contract, deep, include_plan), verbose)
+    
+    results = await asyncio.gather(
+        *(analyze_one(contract) for contract in request.contracts),
+        return_exceptions=True,
+    )
+    return msgspec_response({
+        "results": [
+            {"error": str(result) or type(result).__name__} if isinstance(result, BaseException) else result
+            for result in results
+        ]
+    })
+
 @app.post("/translate-contract")
-async def translate_contract(request: TranslateRequest):
+async def translate_contract(http_request: Request, verbose: bool = False, include_plan: bool = False):
+    request = await decode_body(http_request, translate_decoder)
+    key = cache_key("translate-contract", request.source_code, request.target_language, include_plan)
+    response = await cached_response(key, lambda: _translate_contract(request, include_plan))
+    return msgspec_response(shape_response(response, verbose))
+
+async def _translate_contract(request: TranslateRequest, include_plan=False):
     print(f"Translating contract to {request.target_language}")
+    instance = portia
     try:
-        # Generate plan with Portia
-        translation_plan = portia.plan(
-            f"""Translate this smart contract from its original language to {request.target_language}:
+        # Prompt for the Portia plan, generated alongside the Venice call
+        translation_prompt = f"""Translate this smart contract from its original language to {request.target_language}:
             
             {request.source_code}
             
             Provide detailed comments explaining the key differences between the platforms
             and any important implementation details.
             """
-        )
         
         # Try to use Venice API if available
         venice_messages = [
@@ -209,44 +628,45 @@ async def translate_contract(request: TranslateRequest):
             }
         ]
         
+        translation_plan, venice_response = await plan_and_call_venice(
+            instance, translation_prompt, venice_messages, temperature=0.1,
+            max_tokens=venice_max_tokens(request.source_code), include_plan=include_plan
+        )
+        
         try:
-            venice_response = call_venice_api(venice_messages, temperature=0.1, max_tokens=3000)
-            
-            if venice_response and "choices" in venice_response and len(venice_response["choices"]) > 0:
+            if venice_response_ok(venice_response):
                 content = venice_response["choices"][0]["message"]["content"]
                 
-                return {
-                    "plan": translation_plan.model_dump(),
-                    "results": {
-                        "outputs": {
-                            "final_output": {
-                                "value": content,
-                                "summary": content[:500] + "..." if len(content) > 500 else content
-                            }
-                        }
-                    },
-                    "venice_used": True
-                }
+                return venice_result(translation_plan, content, content)
         except Exception as e:
             print(f"Venice API error: {e}. Falling back to Portia.")
         
         # Fallback to Portia if Venice fails
-        plan_run = portia.run_plan(translation_plan)
+        plan_run = await run_portia(instance.run_plan, translation_plan)
         return {
-            "plan": translation_plan.model_dump(),
-            "results": plan_run.model_dump(),
+            "plan": dump_model(translation_plan),
+            "results": dump_model(plan_run),
             "venice_used": False
         }
+    except httpx.TimeoutException:
+        raise
     except Exception as e:
         print(f"Error translating contract: {str(e)}")
         return {"error": str(e)}
 
 @app.post("/assess-insurance")
-async def assess_insurance(request: InsuranceRequest):
+async def assess_insurance(http_request: Request, verbose: bool = False, deep: bool = False,
+                           include_plan: bool = False):
+    request = await decode_body(http_request, insurance_decoder)
+    key = cache_key("assess-insurance", normalize_solidity(request.contract_code), request.tvl, deep, include_plan)
+    response = await cached_response(key, lambda: _assess_insurance(request, deep, include_plan))
+    return msgspec_response(shape_response(response, verbose))
+
+async def _assess_insurance(request: InsuranceRequest, deep=False, include_plan=False):
+    instance = portia
     try:
-        # Generate plan with Portia
-        assessment_plan = portia.plan(
-            f"""Assess the insurance risk for this smart contract with a Total Value Locked (TVL) of ${request.tvl}:
+        # Prompt for the Portia plan, generated alongside the Venice call
+        assessment_prompt = f"""Assess the insurance risk for this smart contract with a Total Value Locked (TVL) of ${request.tvl}:
             
             {request.contract_code}
             
@@ -261,7 +681,6 @@ async def assess_insurance(request: InsuranceRequest):
             
             Format your response as a JSON structure with these fields.
             """
-        )
         
         # Try to use Venice API if available
         venice_messages = [
@@ -286,63 +705,53 @@ async def assess_insurance(request: InsuranceRequest):
             },
             {
                 "role": "user",
-                "content": f"Assess the insurance risk and premium for this smart contract with TVL of ${request.tvl}:\n\n{request.contract_code}"
+                "content": f"Assess the insurance risk and premium for this smart contract with TVL of ${request.tvl}:\n\n{contract_for_prompt(request.contract_code, deep)}"
             }
         ]
         
+        assessment_plan, venice_response = await plan_and_call_venice(
+            instance, assessment_prompt, venice_messages, temperature=0.1,
+            max_tokens=venice_max_tokens(request.contract_code), include_plan=include_plan
+        )
+        
         try:
-            venice_response = call_venice_api(venice_messages, temperature=0.1, max_tokens=3000)
-            
-            if venice_response and "choices" in venice_response and len(venice_response["choices"]) > 0:
+            if venice_response_ok(venice_response):
                 content = venice_response["choices"][0]["message"]["content"]
                 
                 # Try to parse JSON response
-                try:
-                    json_match = re.search(r'```json\n([\s\S]*?)\n```', content) or re.search(r'```\n([\s\S]*?)\n```', content) or re.search(r'{[\s\S]*?}', content)
-                    if json_match:
-                        json_str = json_match.group(0).replace('```json\n', '').replace('```\n', '').replace('```', '')
-                        parsed_content = json.loads(json_str)
-                    else:
-                        parsed_content = {"raw_response": content}
-                except Exception as e:
-                    print(f"Error parsing JSON content: {e}")
-                    parsed_content = {"raw_response": content}
+                parsed_content = parse_venice_json(content)
                 
-                return {
-                    "plan": assessment_plan.model_dump(),
-                    "results": {
-                        "outputs": {
-                            "final_output": {
-                                "value": parsed_content,
-                                "summary": content[:500] + "..." if len(content) > 500 else content
-                            }
-                        }
-                    },
-                    "venice_used": True
-                }
+                return venice_result(assessment_plan, parsed_content, content)
         except Exception as e:
             print(f"Venice API error: {e}. Falling back to Portia.")
         
         # Fallback to Portia if Venice fails
-        plan_run = portia.run_plan(assessment_plan)
+        plan_run = await run_portia(instance.run_plan, assessment_plan)
         return {
-            "plan": assessment_plan.model_dump(),
-            "results": plan_run.model_dump(),
+            "plan": dump_model(assessment_plan),
+            "results": dump_model(plan_run),
             "venice_used": False
         }
+    except httpx.TimeoutException:
+        raise
     except Exception as e:
         print(f"Error assessing insurance: {str(e)}")
         return {"error": str(e)}
 
 @app.post("/generate-recommendation")
-async def generate_recommendation(request: RecommendationRequest):
+async def generate_recommendation(http_request: Request, verbose: bool = False,
+                                  include_plan: bool = False):
+    request = await decode_body(http_request, recommendation_decoder)
+    return msgspec_response(shape_response(await _generate_recommendation(request, include_plan), verbose))
+
+async def _generate_recommendation(request: RecommendationRequest, include_plan=False):
+    instance = portia
     try:
         overall_score = request.analysis.get('overall_score', 75)
         risk_level = request.analysis.get('vulnerabilities', {}).get('risk_level', 'Medium')
         
-        # Generate plan with Portia
-        recommendation_plan = portia.plan(
-            f"""Based on the following smart contract code and its security analysis, 
+        # Prompt for the Portia plan, generated alongside the Venice call
+        recommendation_prompt = f"""Based on the following smart contract code and its security analysis, 
             generate recommendations for a tokenomics model:
             
             Contract Code:
@@ -361,7 +770,6 @@ async def generate_recommendation(request: RecommendationRequest):
             
             Format your response with clear sections for each recommendation.
             """
-        )
         
         # Try to use Venice API if available
         venice_messages = [
@@ -374,41 +782,43 @@ async def generate_recommendation(request: RecommendationRequest):
             },
             {
                 "role": "user",
-                "content": f"Generate tokenomics recommendations for this contract:\n\n{request.contract_code[:1000]}...\n\nAnalysis: {json.dumps(request.analysis)}"
+                "content": f"Generate tokenomics recommendations for this contract:\n\n{request.contract_code[:1000]}...\n\nAnalysis: {json_encoder.encode(request.analysis).decode()}"
             }
         ]
         
+        recommendation_plan, venice_response = await plan_and_call_venice(
+            instance, recommendation_prompt, venice_messages, temperature=0.7, max_tokens=3000,
+            include_plan=include_plan
+        )
+        
         try:
-            venice_response = call_venice_api(venice_messages, temperature=0.7, max_tokens=3000)
-            
-            if venice_response and "choices" in venice_response and len(venice_response["choices"]) > 0:
+            if venice_response_ok(venice_response):
                 content = venice_response["choices"][0]["message"]["content"]
                 
-                return {
-                    "plan": recommendation_plan.model_dump(),
-                    "results": {
-                        "outputs": {
-                            "final_output": {
-                                "value": content,
-                                "summary": content[:500] + "..." if len(content) > 500 else content
-                            }
-                        }
-                    },
-                    "venice_used": True
-                }
+                return venice_result(recommendation_plan, content, content)
         except Exception as e:
             print(f"Venice API error: {e}. Falling back to Portia.")
         
         # Fallback to Portia if Venice fails
-        plan_run = portia.run_plan(recommendation_plan)
+        plan_run = await run_portia(instance.run_plan, recommendation_plan)
         return {
-            "plan": recommendation_plan.model_dump(),
-            "results": plan_run.model_dump(),
+            "plan": dump_model(recommendation_plan),
+            "results": dump_model(plan_run),
             "venice_used": False
         }
+    except httpx.TimeoutException:
+        raise
     except Exception as e:
         print(f"Error generating recommendation: {str(e)}")
         return {"error": str(e)}
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Each worker is its own process with its own Portia instance, Venice client
+    # and response cache; nothing is shared between workers. uvicorn's default
+    # "auto" loop and HTTP settings use uvloop and httptools when installed.
+    uvicorn.run(
+        "api_server:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=UVICORN_WORKERS,
+    )
\ No newline at end of file
@@ -0,0 +1,111 @@
+import re
+
+# Comments and whitespace are matched alongside string literals so "//" or
+# runs of spaces inside a string are kept
+_SOL_STRING = r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\''
+_SOL_COMMENT = r'//[^\n]*|/\*[\s\S]*?\*/'
+_SOL_STRING_RE = re.compile(_SOL_STRING)
+_SOL_COMMENT_RE = re.compile(rf'({_SOL_STRING})|{_SOL_COMMENT}')
+_SOL_SPACING_RE = re.compile(rf'({_SOL_STRING})|(?:{_SOL_COMMENT}|\s)+')
+
+# Declarations whose body is elided when summarizing a contract
+_SOL_CALLABLE_RE = re.compile(r'^\s*(function|modifier|constructor|fallback|receive)\b')
+
+# Strip comments (including SPDX headers) and collapse whitespace so contracts
+# that differ only in formatting share a cache entry. Only used for cache keys;
+# Portia and Venice always see the original code. Pragmas are kept because the
+# compiler version changes semantics (e.g. checked arithmetic from 0.8).
+def normalize_solidity(code):
+    return _SOL_SPACING_RE.sub(lambda m: m.group(1) or " ", code).strip()
+
+# Replace a string literal's contents with spaces, keeping its quotes and length
+def _blank_string(m):
+    literal = m.group(0)
+    return literal[0] + " " * (len(literal) - 2) + literal[-1]
+
+# Reduce a contract to its outline for the Venice prompt: everything outside
+# function bodies (state vars, mappings, structs, events, signatures) is kept,
+# and each body is cut down to its first line. Returns the code unchanged if
+# its braces don't balance, rather than an outline that silently drops code.
+def extract_solidity_surface(code):
+    stripped_code = _SOL_COMMENT_RE.sub(lambda m: m.group(1) or "", code)
+    # Braces and keywords are read from a copy with string contents blanked,
+    # so e.g. emit Log("{") doesn't throw off the depth
+    masked_code = _SOL_STRING_RE.sub(_blank_string, stripped_code)
+    lines = []
+    depth = 0
+    body_depth = None
+    awaiting_body = False
+    body_lines = 0
+    for line, masked in zip(stripped_code.splitlines(), masked_code.splitlines()):
+        stripped = masked.strip()
+        if not stripped:
+            continue
+        start_depth = depth
+        depth += stripped.count("{") - stripped.count("}")
+
+        if body_depth is not None:
+            if depth < body_depth:
+                # Closing line of the body
+                lines.append(line)
+                body_depth = None
+            elif body_lines == 0:
+                lines.append(line)
+                body_lines = 1
+            elif body_lines == 1:
+                lines.append(line[:len(line) - len(line.lstrip())] + "// ...")
+                body_lines = 2
+            continue
+
+        lines.append(line)
+        if _SOL_CALLABLE_RE.match(masked) and not stripped.endswith(";"):
+            awaiting_body = True
+        if awaiting_body and depth > start_depth:
+            # Signatures may span lines; the body starts where the brace opens
+            body_depth = depth
+            body_lines = 0
+            awaiting_body = False
+        elif awaiting_body and (stripped.endswith(";") or "{" in stripped):
+            awaiting_body = False
+    if depth != 0:
+        return code
+    return "\n".join(lines)
+
+# Return the body of the first fenced block opened by fence. Plain str.find
+# scans stay linear on long LLM output, unlike backtracking regexes.
+def extract_fenced_block(s, fence):
+    start = s.find(fence)
+    if start == -1:
+        return None
+    start += len(fence)
+    end = s.find("\n```", start)
+    if end == -1:
+        return None
+    return s[start:end]
+
+# Return the first balanced top-level {...} in s, skipping braces inside strings
+def extract_json_object(s):
+    start = s.find("{")
+    if start == -1:
+        return None
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(s)):
+        ch = s[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return s[start:i + 1]
+    return None
@@ -0,0 +1,35 @@
+import asyncio
+
+# Run compute() once per key at a time: while it is in flight the registry maps
+# the key to a Future, and concurrent callers with the same key await it. No
+# lock is needed since there is no await between the lookup and the insert.
+async def coalesce(registry, key, compute):
+    while True:
+        future = registry.get(key)
+        if future is None:
+            break
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # If the leader was cancelled (e.g. its client disconnected), retry
+            # instead of inheriting its cancellation; otherwise we were cancelled
+            if not future.cancelled():
+                raise
+
+    future = asyncio.get_running_loop().create_future()
+    registry[key] = future
+    try:
+        result = await compute()
+    except Exception as e:
+        future.set_exception(e)
+        # Mark it retrieved so asyncio doesn't warn when nobody else was waiting
+        future.exception()
+        raise
+    except BaseException:
+        future.cancel()
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        registry.pop(key, None)
@@ -1,3 +1,4 @@
+import os
 from dotenv import load_dotenv
 from portia import (
     Config,
@@ -7,18 +8,13 @@ from portia import (
 )
 from portia.open_source_tools.registry import example_tool_registry
 
-# If you want to define custom tools, first check the available classes
-# Try to inspect what's available in the portia package
-import portia
-print(dir(portia))  # This will print all available attributes in the portia module
-
 load_dotenv()
 
 # Configure Portia
 my_config = Config.from_default(
     storage_class=StorageClass.DISK, 
     storage_dir='blockchain_runs',
-    default_log_level=LogLevel.DEBUG,
+    default_log_level=LogLevel[os.getenv("PORTIA_LOG_LEVEL", "INFO")],
 )
 
 # For now, let's just use the example tools
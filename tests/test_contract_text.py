@@ -0,0 +1,80 @@
+from contract_text import (
+    extract_fenced_block,
+    extract_json_object,
+    extract_solidity_surface,
+    normalize_solidity,
+)
+
+CONTRACT = """// SPDX-License-Identifier: MIT
+pragma solidity ^0.8.0;
+
+contract Vault {
+    address public owner;
+    mapping(address => uint256) public balances;
+
+    event Log(string message);
+
+    function deposit() public payable {
+        emit Log("{");
+        balances[msg.sender] += msg.value;
+        owner = owner;
+    }
+
+    function withdraw(uint256 amount) public {
+        require(balances[msg.sender] >= amount);
+        balances[msg.sender] -= amount;
+        payable(msg.sender).transfer(amount);
+    }
+
+    function setOwner(address newOwner) public {
+        owner = newOwner;
+    }
+}
+"""
+
+
+def test_normalize_solidity_strips_comments_and_whitespace():
+    code = "contract A {  // note\n    uint x; /* block\n comment */ }"
+    assert normalize_solidity(code) == "contract A { uint x; }"
+
+
+def test_normalize_solidity_keeps_string_literals():
+    assert normalize_solidity('s = "a // b";') == 's = "a // b";'
+    assert normalize_solidity('s = "a  b";') != normalize_solidity('s = "a b";')
+
+
+def test_surface_elides_function_bodies():
+    surface = extract_solidity_surface(CONTRACT)
+    assert "mapping(address => uint256) public balances;" in surface
+    assert "function withdraw(uint256 amount) public {" in surface
+    assert "payable(msg.sender).transfer(amount);" not in surface
+    assert "SPDX" not in surface
+
+
+def test_surface_ignores_braces_in_strings():
+    surface = extract_solidity_surface(CONTRACT)
+    assert "function withdraw(uint256 amount) public {" in surface
+    assert "function setOwner(address newOwner) public {" in surface
+    assert surface.rstrip().endswith("}")
+
+
+def test_surface_falls_back_to_full_code_when_unbalanced():
+    code = "contract A {\n    function f() public {\n        x = 1;\n"
+    assert extract_solidity_surface(code) == code
+
+
+def test_extract_fenced_block():
+    content = 'Here:\n```json\n{"a": 1}\n```\nDone'
+    assert extract_fenced_block(content, "```json\n") == '{"a": 1}'
+    assert extract_fenced_block("no fence", "```json\n") is None
+    assert extract_fenced_block("```json\n{\"a\": 1}", "```json\n") is None
+
+
+def test_extract_json_object_skips_braces_in_strings():
+    content = 'Result: {"a": "}{", "b": {"c": "\\"}"}} trailing }'
+    assert extract_json_object(content) == '{"a": "}{", "b": {"c": "\\"}"}}'
+
+
+def test_extract_json_object_without_object():
+    assert extract_json_object("no json here") is None
+    assert extract_json_object('{"a": 1') is None
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+from inflight import coalesce
+
+
+def test_concurrent_callers_share_one_call():
+    async def main():
+        registry = {}
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "result"
+
+        results = await asyncio.gather(*(coalesce(registry, "k", compute) for _ in range(5)))
+        return results, calls, registry
+
+    results, calls, registry = asyncio.run(main())
+    assert results == ["result"] * 5
+    assert len(calls) == 1
+    assert registry == {}
+
+
+def test_exception_is_shared_with_waiters():
+    async def main():
+        registry = {}
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        results = await asyncio.gather(
+            *(coalesce(registry, "k", compute) for _ in range(3)),
+            return_exceptions=True,
+        )
+        return results, calls, registry
+
+    results, calls, registry = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len(calls) == 1
+    assert registry == {}
+
+
+def test_waiter_retries_when_leader_is_cancelled():
+    async def main():
+        registry = {}
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return len(calls)
+
+        leader = asyncio.create_task(coalesce(registry, "k", compute))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(coalesce(registry, "k", compute))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await waiter, calls, registry
+
+    result, calls, registry = asyncio.run(main())
+    # The waiter became the new leader instead of inheriting the cancellation
+    assert result == 2
+    assert len(calls) == 2
+    assert registry == {}
+
+
+def test_cancelled_waiter_does_not_cancel_leader():
+    async def main():
+        registry = {}
+
+        async def compute():
+            await asyncio.sleep(0.02)
+            return "result"
+
+        leader = asyncio.create_task(coalesce(registry, "k", compute))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(coalesce(registry, "k", compute))
+        await asyncio.sleep(0.005)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return await leader
+
+    assert asyncio.run(main()) == "result"